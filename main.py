@@ -16,137 +16,451 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import time
+import io
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import yaml
-import json
+try:
+    # libyaml C extension, falls back to the pure Python loader if PyYAML was built without it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+import orjson
+import xxhash
+import simdjson
 import psycopg2
-import time
+from psycopg2.extras import execute_values
 import sqlite3
+import queue
+import threading
 from pythorhead import Lemmy
+from pythorhead.requestor import REQUEST_MAP, Request
 from alive_progress import alive_bar
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 logging.basicConfig(filename='output/out.log', level=logging.ERROR, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+class RateLimiter:
+    """Token bucket rate limiter, used as `async with limiter:` before each request
+    The refill rate is retuned from the X-Ratelimit headers of each response
+    rate -> requests allowed per period
+    period -> period length in seconds
+    """
+
+    def __init__(self, rate: int, period: float):
+        self.capacity = rate
+        self.tokens = rate
+        self.refill_rate = rate / period
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        """Add the tokens earned since the last refill"""
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    async def __aenter__(self):
+        # Waiters are served in order, the lock is held while waiting for a token
+        async with self.lock:
+            self.refill()
+            while (self.tokens < 1):
+                await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+                self.refill()
+            self.tokens -= 1
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def update(self, headers):
+        """Retune the bucket from rate limit response headers, if present
+        headers -> response headers
+        """
+
+        try:
+            remaining = float(headers['X-Ratelimit-Remaining'])
+            reset = float(headers['X-Ratelimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        # Spread what is left of the budget over the time until the window resets
+        self.refill()
+        self.tokens = min(self.tokens, remaining)
+        self.refill_rate = max(remaining, 1) / max(reset, 1)
+
+# Want to make sure we stay under the Reddit rate limit
+# 10 per minute, but 6 per minute is used until Reddit reports the real budget
+reddit_limiter = RateLimiter(6, 60)
+
+# Limit on posts being copied at once, each holds its whole comment thread in memory
+POST_CONCURRENCY = 8
+post_slots = asyncio.Semaphore(POST_CONCURRENCY)
+
+# Limit on concurrent comment creation requests against Lemmy
+LEMMY_CONCURRENCY = 16
+lemmy_slots = asyncio.Semaphore(LEMMY_CONCURRENCY)
+
+# pythorhead is synchronous, its calls run on these threads so they don't block the event loop
+# Sized to LEMMY_CONCURRENCY, the default executor can have fewer workers on small machines
+lemmy_pool = ThreadPoolExecutor(max_workers=LEMMY_CONCURRENCY, thread_name_prefix='lemmy')
+
+# Most comment ids the Reddit morechildren API accepts per request
+MORE_CHILDREN_LIMIT = 100
+
+# Reddit only allows one morechildren request at a time per client, concurrent ones get an error back
+more_children_lock = asyncio.Lock()
+
+# Score batches at least this large are loaded with COPY rather than sent as an inline VALUES list
+SCORE_COPY_THRESHOLD = 1000
+
+# Post information kept from the Reddit API, as {post key: Reddit field}
+POST_FIELDS = {
+    'title': 'title',
+    'url': 'url',
+    'body': 'selftext',
+    'creator_id': 'author',
+    'subreddit': 'subreddit',
+    'nsfw': 'over_18',
+    'score': 'score',
+    'id': 'id'
+}
+
+@dataclass(frozen=True, slots=True)
+class LemmyConfig:
+    """lemmy section of config.yml"""
+    url: str
+    pg_host: str
+    pg_port: int
+    pg_db: str
+
+@dataclass(frozen=True, slots=True)
+class Credentials:
+    """credentials section of config.yml"""
+    lemmy_user: str
+    lemmy_pass: str
+    pg_user: str
+    pg_pass: str
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Parsed config.yml"""
+    lemmy: LemmyConfig
+    credentials: Credentials
+    subreddits: tuple
+    po_subreddits: tuple
+
+@dataclass(frozen=True, slots=True)
+class RedditPost:
+    """Post fields used from the Reddit API"""
+    id: str
+    title: str
+    url: str
+    body: str
+    creator_id: str
+    subreddit: str
+    nsfw: bool
+    score: int
+
+@dataclass(frozen=True, slots=True)
+class RedditComment:
+    """Comment fields used from the Reddit API"""
+    id: str
+    body: str
+    score: int
+    replies: list  # unparsed children of the replies listing
+
+# Data for failed posts/comments, written to the error log by write_error_log
+error_queue = queue.Queue()
+
 def load_yaml(file: str):
     """Load yaml file
     file -> string location of the file to load
     """
 
     with open(file, 'r') as f:
-        data = yaml.safe_load(f)
+        data = yaml.load(f, Loader=SafeLoader)
     return data
 
-def lemmy_setup(config: dict):
+def load_config(file: str):
+    """Load config.yml into a frozen Config
+    file -> string location of the config file
+    """
+
+    data = load_yaml(file)
+    return Config(
+        lemmy = LemmyConfig(**data['lemmy']),
+        credentials = Credentials(**data['credentials']),
+        subreddits = tuple(data['subreddits'] or ()),
+        po_subreddits = tuple(data['po_subreddits'] or ())
+    )
+
+def write_error_log(file: str):
+    """Write data queued on error_queue to a JSON lines file, runs in a background thread
+    Stops once None is queued
+    file -> string location of the error log
+    """
+
+    with open(file, 'ab') as f:
+        while True:
+            entry = error_queue.get()
+            if (entry is None):
+                break
+            kind, data = entry
+            f.write(orjson.dumps({'kind': kind, 'data': data}) + b'\n')
+            # Flush once the queue is drained so a crash can't lose errors sitting in the buffer
+            if (error_queue.empty()):
+                f.flush()
+
+def lemmy_setup(config: Config):
     """Initialize and login to Lemmy
-    config -> config.yml dictionary 
+    config -> parsed config.yml
     """
 
-    lemmy = Lemmy(config['lemmy']['url'])
-    lemmy.log_in(config['credentials']['lemmy_user'], config['credentials']['lemmy_pass'])
+    # pythorhead calls requests.get/put/post directly, opening a new connection per request
+    # Route its calls through one session so connections to Lemmy are kept alive and reused
+    # Lemmy rate limits also get retried here with backoff, honouring Retry-After
+    # A 429 means the request was not processed, so it is safe to retry even for POSTs
+    # Read errors are not retried, the comment/post may already have been created
+    retries = Retry(total=5, read=0, backoff_factor=1, status_forcelist=[429], allowed_methods=None, raise_on_status=False)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=LEMMY_CONCURRENCY, pool_maxsize=LEMMY_CONCURRENCY, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    REQUEST_MAP[Request.GET] = session.get
+    REQUEST_MAP[Request.PUT] = session.put
+    REQUEST_MAP[Request.POST] = session.post
+
+    lemmy = Lemmy(config.lemmy.url)
+    lemmy.log_in(config.credentials.lemmy_user, config.credentials.lemmy_pass)
     return lemmy
 
+@functools.lru_cache(maxsize=None)
+def get_community_id(lemmy: Lemmy, name: str):
+    """Find the ID of the matching community name on Lemmy
+    Results are cached, communities are looked up once per run
+    lemmy -> Lemmy instance connection
+    name -> community name (matches the subreddit name)
+    """
+
+    return lemmy.community.get(name=name)['community_view']['community']['id']
+
+async def run_lemmy(func, *args, **kwargs):
+    """Run a blocking pythorhead call on lemmy_pool
+    func -> pythorhead method (i.e. lemmy.post.create)
+    args, kwargs -> passed through to func
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(lemmy_pool, functools.partial(func, *args, **kwargs))
+
 def load_db(file: str):
     """Load sqlite3 db connection
     file -> string location of the sqlite3 db
     """
 
     # Create the DB connection and open cursor
-    db = sqlite3.connect(file)
+    db = sqlite3.connect(file, cached_statements=512)
+
+    # WAL with synchronous=NORMAL only syncs on checkpoints instead of every commit
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
     sq_cursor = db.cursor()
+    existing = {row[0] for row in sq_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('posts', 'comments')")}
+
+    # Create any missing tables and the indexes in a single transaction
+    # sqlite3 only opens transactions implicitly for DML, so DDL needs an explicit BEGIN
+    with db:
+        sq_cursor.execute("BEGIN")
+        # Check if the posts table is created, if not make it
+        if ('posts' in existing):
+            logging.debug(f"{file} table 'posts' exists")
+        else:
+            sq_cursor.execute("CREATE TABLE posts(reddit_post_id text, lemmy_post_id text, post_score integer, post_hash text)")
+            logging.debug(f"{file} table 'posts' created")
+
+        # Check if the comments table is created, if not make it
+        if ('comments' in existing):
+            logging.debug(f"{file} table 'comments' exists")
+        else:
+            sq_cursor.execute("CREATE TABLE comments(reddit_comment_id text, lemmy_comment_id text, reddit_post_id text, lemmy_post_id text, comment_score integer, comment_hash text)")
+            logging.debug(f"{file} table 'comments' created")
+
+        # Index the dupe lookups, run every time so existing DBs get them too
+        sq_cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_rid ON posts(reddit_post_id)")
+        sq_cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_rpid_rcid ON comments(reddit_post_id, reddit_comment_id)")
 
-    # Check if the posts table is created, if not make it
-    try:
-        sq_cursor.execute("SELECT * FROM posts")
-        logging.debug(f"{file} table 'posts' exists")
-    except sqlite3.OperationalError:
-        sq_cursor.execute("CREATE TABLE posts(reddit_post_id text, lemmy_post_id text, post_score integer, post_hash text)")
-        db.commit()
-        logging.debug(f"{file} table 'posts' created")
-    
-    # Check if the comments table is created, if not make it
-    try:
-        sq_cursor.execute("SELECT * FROM comments")
-        logging.debug(f"{file} table 'comments' exists")
-    except sqlite3.OperationalError:
-        sq_cursor.execute("CREATE TABLE comments(reddit_comment_id text, lemmy_comment_id text, reddit_post_id text, lemmy_post_id text, comment_score integer, comment_hash text)")
-        db.commit()
-        logging.debug(f"{file} table 'comments' created")
-    
     sq_cursor.close()
     return db
 
-def pg_setup(config: dict):
+def pg_setup(config: Config):
     """Initialize and connect to postgres
-    config -> config.yml dictionary
+    config -> parsed config.yml
     """
 
     pg = psycopg2.connect(
-        database = config['lemmy']['pg_db'],
-        host = config['lemmy']['pg_host'],
-        port = config['lemmy']['pg_port'],
-        user = config['credentials']['pg_user'],
-        password = config['credentials']['pg_pass']
+        database = config.lemmy.pg_db,
+        host = config.lemmy.pg_host,
+        port = config.lemmy.pg_port,
+        user = config.credentials.pg_user,
+        password = config.credentials.pg_pass
     )
     return pg
 
-def get_json(endpoint: str):
+@retry(wait=wait_exponential(multiplier=1, max=60), stop=stop_after_attempt(5), retry=retry_if_exception_type((aiohttp.ClientError, asyncio.TimeoutError)), reraise=True)
+async def reddit_get(session: aiohttp.ClientSession, url: str):
+    """Conduct a rate limited GET request against the Reddit API, returning the raw body
+    Retries with exponential backoff on connection errors, 429s and 5xx responses
+    session -> shared aiohttp client session
+    url -> full url to request
+    """
+
+    async with reddit_limiter:
+        async with session.get(url) as response:
+            reddit_limiter.update(response.headers)
+            if (response.status == 429 or response.status >= 500):
+                response.raise_for_status()
+            return await response.read()
+
+async def get_json(session: aiohttp.ClientSession, endpoint: str, limit: int = 10000):
     """Conduct the Reddit API request for a post
+    session -> shared aiohttp client session
     endpoint -> the api endpoint to hit
+    limit -> most comments to return alongside the post, defaults 10000
     """
 
-    headers = {
-        'User-agent': 'RLC 0.1'
-    }
-    url = f"https://reddit.com{endpoint}.json?limit=10000"
-    response = requests.get(url, headers=headers)
-    return response.json()
+    url = f"https://reddit.com{endpoint}.json?limit={limit}&raw_json=1"
+    return orjson.loads(await reddit_get(session, url))
 
-def get_frontpage(subreddit: str):
+async def get_frontpage(session: aiohttp.ClientSession, subreddit: str):
     """Get the API response for a subreddit frontpage
+    Parsed with simdjson, only the fields get_permalinks reads are turned into Python objects
+    session -> shared aiohttp client session
     subreddit -> subreddit to hit (i.e. /r/tifu/)
     """
 
-    headers = {
-        'User-agent': 'RLC 0.1'
-    }
-    url = f"https://reddit.com{subreddit}.json"
+    # raw_json=1 matches get_json, so text fields hash the same from either response
+    url = f"https://reddit.com{subreddit}.json?raw_json=1"
     print(url)
-    response = requests.get(url, headers=headers)
-    return response.json()
+    # A parser invalidates its previous document on reuse, so each frontpage gets its own
+    return simdjson.Parser().parse(await reddit_get(session, url))
 
-def check_dupe(db: sqlite3.Connection, post: dict = {}, comment: dict = {}):
-    """Checks sqlite3 db for a duplicate post/comment based on reddit post/comment id
-    Only post OR comment should be passed, not both at once
+def load_seen_posts(db: sqlite3.Connection, reddit_post_ids: list):
+    """Get which of the given Reddit posts have already been copied to Lemmy, as {reddit post id: (lemmy post id, post hash)}
+    Uses a single query backed by idx_posts_rid instead of loading every copied post
     db -> sqlite3 db connection
-    post -> post data dict (defaults empty/false)
-    comment -> comment data dict (defaults empty/false)
+    reddit_post_ids -> Reddit post ids to look up
+    """
+
+    if (not reddit_post_ids):
+        return {}
+
+    db_cursor = db.cursor()
+    seen = {row[0]: (row[1], row[2]) for row in db_cursor.execute(f"SELECT reddit_post_id, lemmy_post_id, post_hash FROM posts WHERE reddit_post_id IN ({','.join('?' * len(reddit_post_ids))})", reddit_post_ids)}
+    db_cursor.close()
+    return seen
+
+def load_copied_comments(db: sqlite3.Connection, reddit_post_id: str):
+    """Get the comments of a post that have already been copied to Lemmy, as {reddit comment id: lemmy comment id}
+    db -> sqlite3 db connection
+    reddit_post_id -> Reddit post id
+    """
+
+    db_cursor = db.cursor()
+    copied = dict(db_cursor.execute("SELECT reddit_comment_id, lemmy_comment_id FROM comments WHERE reddit_post_id = ?", (reddit_post_id,)))
+    db_cursor.close()
+    return copied
+
+async def get_more_children(session: aiohttp.ClientSession, link_id: str, children: list):
+    """Get unloaded comments of a post from the Reddit morechildren API
+    session -> shared aiohttp client session
+    link_id -> fullname of the post (i.e. t3_xxx)
+    children -> ids of the comments to load, at most MORE_CHILDREN_LIMIT
+    """
+
+    url = f"https://reddit.com/api/morechildren.json?api_type=json&raw_json=1&limit_children=false&link_id={link_id}&children={','.join(children)}"
+    return orjson.loads(await reddit_get(session, url))['json']['data']['things']
+
+async def load_more_comments(session: aiohttp.ClientSession, reddit_post_id: str, data: dict):
+    """Load the comments hidden behind 'more' placeholders and add them to the comment listing in place
+    The morechildren requests are made one at a time across all posts, guarded by more_children_lock
+    Returns False if any of them failed, so the post is retried next run
+    session -> shared aiohttp client session
+    reddit_post_id -> Reddit post id
+    data -> comment data returned by Reddit API
+    """
+
+    link_id = f"t3_{reddit_post_id}"
+
+    # Index the loaded comments by fullname and collect the ids of the unloaded ones
+    comments = {}
+    more_ids = []
+    stack = list(data['data']['children'])
+    while stack:
+        child = stack.pop()
+        if (child['kind'] == 'more'):
+            more_ids.extend(child['data']['children'])
+        else:
+            comments[f"t1_{child['data']['id']}"] = child['data']
+            if (child['data']['replies'] != ""):
+                stack.extend(child['data']['replies']['data']['children'])
+
+    if (not more_ids):
+        return True
+
+    complete = True
+    for i in range(0, len(more_ids), MORE_CHILDREN_LIMIT):
+        chunk = more_ids[i:i + MORE_CHILDREN_LIMIT]
+        try:
+            async with more_children_lock:
+                things = await get_more_children(session, link_id, chunk)
+        except Exception as e:
+            logging.error(f"Could not load more comments for post {reddit_post_id}: {e}")
+            error_queue.put(('more_children', {'reddit_post_id': reddit_post_id, 'children': chunk, 'error': repr(e)}))
+            complete = False
+            continue
+
+        # Things come back flat with parents before their replies, attach each one under its parent
+        for thing in things:
+            if (thing['kind'] == 'more'):
+                continue
+            parent_id = thing['data']['parent_id']
+            if (parent_id == link_id):
+                data['data']['children'].append(thing)
+            elif (parent_id in comments):
+                parent = comments[parent_id]
+                if (parent['replies'] == ""):
+                    parent['replies'] = {'kind': 'Listing', 'data': {'children': []}}
+                parent['replies']['data']['children'].append(thing)
+            else:
+                continue
+            comments[f"t1_{thing['data']['id']}"] = thing['data']
+
+    return complete
+
+def check_dupe(db: sqlite3.Connection, post: RedditPost):
+    """Checks sqlite3 db for a duplicate post based on reddit post id
+    db -> sqlite3 db connection
+    post -> post parsed from Reddit API
     """
 
     db_cursor = db.cursor()
     row_list = []
-    if (post):
-        db_data = db_cursor.execute(f"SELECT reddit_post_id, lemmy_post_id, post_score FROM posts WHERE reddit_post_id='{post['id']}'").fetchall()
-        for row in db_data or []:
-            db_dict = {
-                'reddit_post_id': row[0],
-                'lemmy_post_id': row[1],
-                'post_score': row[2]
-            }
-            row_list.append(db_dict)
-    elif (comment):
-        db_data = db_cursor.execute(f"SELECT reddit_post_id, lemmy_post_id, lemmy_comment_id, reddit_comment_id, comment_score FROM comments WHERE reddit_post_id='{comment['reddit_post_id']}' AND reddit_comment_id='{comment['reddit_comment_id']}'").fetchall()
-        for row in db_data or []:
-            db_dict = {
-                'reddit_post_id': row[0],
-                'lemmy_post_id': row[1],
-                'lemmy_comment_id': row[2],
-                'reddit_comment_id': row[3],
-                'comment_score': row[4]
-            }
-            row_list.append(db_dict)
-    else:
-        logging.error(f"check_dupe called but no data was passed.")
+    db_data = db_cursor.execute("SELECT reddit_post_id, lemmy_post_id, post_score FROM posts WHERE reddit_post_id = ?", (post.id,)).fetchall()
+    for row in db_data or []:
+        db_dict = {
+            'reddit_post_id': row[0],
+            'lemmy_post_id': row[1],
+            'post_score': row[2]
+        }
+        row_list.append(db_dict)
     
     db_cursor.close()
 
@@ -158,321 +472,459 @@ def check_dupe(db: sqlite3.Connection, post: dict = {}, comment: dict = {}):
     else:
         return []
 
-def save_entry(db: sqlite3.Connection, comment_data: dict = {}, post_data: dict = {}, comment: dict = {}, post: dict = {}):
-    """Save post/comment information to sqlite3
+def post_hash(title: str, body: str, url: str, score: int):
+    """Hash the post fields that can change between scrapes, stored so unchanged posts can be skipped
+    title, body, url, score -> post fields from the Reddit API
+    """
+
+    return xxhash.xxh64_hexdigest(f"{title}\x00{body}\x00{url}\x00{score}".encode())
+
+def save_entries(db: sqlite3.Connection, posts: list = [], comments: list = []):
+    """Save post/comment information to sqlite3 in a single transaction
     db -> sqlite3 db connection
-    comment_data -> comment data from Lemmy
-    post_data -> post data from Lemmy
-    comment -> comment information parsed from Reddit API
-    post -> post information parsed from Reddit API
+    posts -> list of (reddit_post_id, lemmy_post_id, post_score) tuples, post_hash is set by update_posts once the score is fixed
+    comments -> list of (reddit_comment_id, lemmy_comment_id, reddit_post_id, lemmy_post_id, comment_score) tuples
     """
 
-    db_cursor = db.cursor()
-    if (comment_data and comment):
-        db_cursor.execute(f"""
-        INSERT INTO comments (reddit_comment_id, lemmy_comment_id, reddit_post_id, lemmy_post_id, comment_score)
-                          VALUES ('{comment['reddit_comment_id']}', '{comment['lemmy_comment_id']}', '{comment['reddit_post_id']}', '{comment['lemmy_post_id']}', {comment['comment_score']})
-        """)
-        pass
-    elif (post_data and post):
-        db_cursor.execute(f"""
-        INSERT INTO posts (reddit_post_id, lemmy_post_id, post_score)
-                          VALUES ('{post['id']}', '{post_data['post_view']['post']['id']}', {post['score']})
-        """)
-    else: 
-        logging.error('save_entry called incorrectly')
+    with db:
+        if (posts):
+            db.executemany("INSERT INTO posts (reddit_post_id, lemmy_post_id, post_score) VALUES (?, ?, ?)", posts)
+        if (comments):
+            db.executemany("INSERT INTO comments (reddit_comment_id, lemmy_comment_id, reddit_post_id, lemmy_post_id, comment_score) VALUES (?, ?, ?, ?, ?)", comments)
 
-    db.commit()
-    db_cursor.close()
+def update_posts(db: sqlite3.Connection, posts: list):
+    """Save the score and hash of posts whose score was fixed on Lemmy
+    db -> sqlite3 db connection
+    posts -> list of (post_score, post_hash, reddit_post_id) tuples
+    """
+
+    with db:
+        db.executemany("UPDATE posts SET post_score = ?, post_hash = ? WHERE reddit_post_id = ?", posts)
 
-def fix_comment_score(pg: psycopg2.extensions.connection, comment_data: dict, item: dict):
-    """Edit comment data in postgres to match score on Reddit
-    pg -> postgres db connection
+def fix_comment_score(score_updates: list, comment_data: dict, item: RedditComment):
+    """Queue a comment score correction so it matches the score on Reddit
+    score_updates -> list of (comment_id, score) tuples, flushed by flush_comment_scores
     comment_data -> comment data returned by pythorhead on creation
-    item -> comment data from Reddit API
+    item -> comment parsed from Reddit API
     """
 
-    score = item['data']['score']
+    score = item.score
     if score == 1:
         # If the score is 1, then it doesn't need to be updated on Lemmy
         # By default all comments on Lemmy have a score of 1
         logging.info(f"Comment {comment_data['comment_view']['comment']['id']} has a score of 1, skipping")
-        return
     else:
-        query = f"UPDATE comment_aggregates SET score = {score} WHERE comment_id = {comment_data['comment_view']['comment']['id']};"
-
-        pg_cursor = pg.cursor()
-        pg_cursor.execute(query)
+        score_updates.append((comment_data['comment_view']['comment']['id'], score))
 
-        pg.commit()
-        pg_cursor.close()
-
-        logging.info(f"Fixed score for comment {comment_data['comment_view']['comment']['id']} to {score}")
-
-def fix_post_score(pg: psycopg2.extensions.connection, post_data: dict, post: dict):
-    """Edit post data in postgres to match score on Reddit
-    pg -> postgres db connection
+def fix_post_score(score_updates: list, post_data: dict, post: RedditPost):
+    """Queue a post score correction so it matches the score on Reddit
+    score_updates -> list of (post_id, score) tuples, flushed by flush_post_scores
     post_data -> post data returned by pythorhead on creation
-    post -> post data from Reddit API
+    post -> post parsed from Reddit API
     """
 
-    score = post['score']
+    score = post.score
     if score == 1:
         # If the score is 1, then it doesn't need to be updated on Lemmy
-        # By default all comments on Lemmy have a score of 1
+        # By default all posts on Lemmy have a score of 1
         logging.info(f"Post {post_data['post_view']['post']['id']} has a score of 1, skipping")
     else:
-        query = f"UPDATE post_aggregates SET score = {score} WHERE post_id = {post_data['post_view']['post']['id']};"
+        score_updates.append((post_data['post_view']['post']['id'], score))
+
+def stage_scores(pg_cursor: psycopg2.extensions.cursor, score_updates: list):
+    """Bulk load (id, score) tuples into the tmp_scores temp table using COPY
+    tmp_scores is dropped on commit
+    pg_cursor -> long-lived postgres cursor
+    score_updates -> list of (id, score) tuples
+    """
+
+    pg_cursor.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_scores(id bigint, score integer) ON COMMIT DROP")
+    buf = io.BytesIO("".join(f"{row_id}\t{score}\n" for row_id, score in score_updates).encode())
+    pg_cursor.copy_expert("COPY tmp_scores FROM STDIN", buf)
+
+def flush_comment_scores(pg_cursor: psycopg2.extensions.cursor, score_updates: list):
+    """Write queued comment scores to postgres in a single statement and transaction
+    Small batches are sent inline, batches of SCORE_COPY_THRESHOLD or more are loaded with COPY first
+    pg_cursor -> long-lived postgres cursor
+    score_updates -> list of (comment_id, score) tuples
+    """
+
+    if (not score_updates):
+        return
+
+    if (len(score_updates) < SCORE_COPY_THRESHOLD):
+        execute_values(pg_cursor, "UPDATE comment_aggregates AS ca SET score = v.score FROM (VALUES %s) AS v(id, score) WHERE ca.comment_id = v.id", score_updates, page_size=len(score_updates))
+    else:
+        stage_scores(pg_cursor, score_updates)
+        pg_cursor.execute("UPDATE comment_aggregates AS ca SET score = tmp_scores.score FROM tmp_scores WHERE ca.comment_id = tmp_scores.id")
+    pg_cursor.connection.commit()
+
+    logging.info(f"Fixed score for {len(score_updates)} comments")
+
+def flush_post_scores(pg_cursor: psycopg2.extensions.cursor, score_updates: list):
+    """Write queued post scores to postgres in a single statement and transaction
+    Small batches are sent inline, batches of SCORE_COPY_THRESHOLD or more are loaded with COPY first
+    pg_cursor -> long-lived postgres cursor
+    score_updates -> list of (post_id, score) tuples
+    """
+
+    if (not score_updates):
+        return
+
+    if (len(score_updates) < SCORE_COPY_THRESHOLD):
+        execute_values(pg_cursor, "UPDATE post_aggregates AS pa SET score = v.score FROM (VALUES %s) AS v(id, score) WHERE pa.post_id = v.id", score_updates, page_size=len(score_updates))
+    else:
+        stage_scores(pg_cursor, score_updates)
+        pg_cursor.execute("UPDATE post_aggregates AS pa SET score = tmp_scores.score FROM tmp_scores WHERE pa.post_id = tmp_scores.id")
+    pg_cursor.connection.commit()
 
-        pg_cursor = pg.cursor()
-        pg_cursor.execute(query)
+    logging.info(f"Fixed score for {len(score_updates)} posts")
 
-        pg.commit()
-        pg_cursor.close()
+def flatten_comments(children: list):
+    """Parse the fields used from Reddit comment listing children into RedditComments
+    Unloaded comments (kind 'more') are dropped
+    children -> children of a Reddit comment listing
+    """
 
-        logging.info(f"Fixed score for post {post_data['post_view']['post']['id']} to {score}")
-    pass
+    return [
+        RedditComment(
+            id = data['id'],
+            body = data['body'],
+            score = data['score'],
+            # Reddit uses an empty string when a comment has no replies
+            replies = data['replies']['data']['children'] if data['replies'] else []
+        )
+        for data in (child['data'] for child in children if child['kind'] != 'more')
+    ]
+
+async def create_comment(lemmy: Lemmy, post_id: int, body: str, parent_id: int = None):
+    """Create a comment on Lemmy without blocking the event loop
+    Concurrent comment creation is limited by lemmy_slots
+    lemmy -> Lemmy instance connection
+    post_id -> Lemmy post id to comment on
+    body -> comment body
+    parent_id -> Lemmy comment id to reply to, if applicable (defaults None)
+    """
 
-def parse_comments(pg: psycopg2.extensions.connection, lemmy: Lemmy, post_data: dict, data: dict, post: dict, db: sqlite3.Connection, parent_comment: dict = {}):
+    async with lemmy_slots:
+        return await run_lemmy(lemmy.comment.create, post_id, body, parent_id=parent_id)
+
+async def parse_comments(lemmy: Lemmy, pg_cursor: psycopg2.extensions.cursor, post_data: dict, data: dict, post: RedditPost, db: sqlite3.Connection):
     """Parse through comments and create them on the Lemmy post
-    pg -> postgres db connection
+    Comments are created one level of the comment tree at a time, siblings are created concurrently
+    Each level is saved to sqlite3 and has its scores fixed before the next, so an interrupted post can be resumed
+    Returns False if any comment could not be pushed, saved or have its score fixed, so the post is retried next run
     lemmy -> Lemmy instance connection
+    pg_cursor -> long-lived postgres cursor
     post_data -> post data returned by pythorhead on creation
     data -> comment data returned by Reddit API
-    post -> post information parsed from Reddit API
-    parent_comment -> parent comment information, if applicable (defaults empty/false)
+    post -> post parsed from Reddit API
+    db -> sqlite3 db connection
     """
 
-    for item in data['data']['children']:
-        # Iterate over all the comments
-        if (item['kind'] == 'more'):
-            # This comment type is for unloaded comments, should be ignored
-            pass
-        else:
-            comment = {
-                'reddit_post_id': post['id'],
-                'reddit_comment_id': item['data']['id'],
-                'lemmy_post_id': post_data['post_view']['post']['id'],
-                'comment_score': item['data']['score']
-            }
+    # Look up every comment of this post already in sqlite at once
+    copied = load_copied_comments(db, post.id)
+    lemmy_post_id = int(post_data['post_view']['post']['id'])
+    complete = True
+
+    # Each level holds (lemmy parent comment id, reddit comment) pairs
+    level = [(None, item) for item in flatten_comments(data['data']['children'])]
+    while level:
+        next_level = []
+        pending = []
+        score_updates = []
+        entries = []
+        for parent_id, item in level:
+            if (item.id in copied):
+                logging.info(f"Duplicate comment found: {item.id}")
+                # Replies should still be attached to the existing comment
+                next_level.extend((int(copied[item.id]), child) for child in flatten_comments(item.replies))
+            else:
+                # Copy over the comment, if it has a parent comment then the context should be preserved
+                pending.append((parent_id, item))
+
+        results = await asyncio.gather(*[create_comment(lemmy, lemmy_post_id, item.body, parent_id) for parent_id, item in pending], return_exceptions=True)
+
+        for (parent_id, item), comment_data in zip(pending, results):
+            lemmy_comment_id = None
 
-            comment_data = {}
-            if (check_dupe(db, comment=comment)):
-                logging.info(f"Duplicate comment found: {comment['reddit_comment_id']}")
+            # pythorhead returns None instead of raising when the API call fails
+            if (not comment_data or isinstance(comment_data, Exception)):
+                logging.error(f"Could not push comment {item.id}")
+                error_queue.put(('comment', item))
+                complete = False
             else:
-                comment_made = False
+                lemmy_comment_id = comment_data['comment_view']['comment']['id']
 
-                # Copy over the comment, if it has a parent comment then the context should be preserved
-                if (parent_comment):
-                    try:
-                        comment_data = lemmy.comment.create(int(post_data['post_view']['post']['id']), item['data']['body'], parent_id=parent_comment['comment_view']['comment']['id'])
-                        comment['lemmy_comment_id'] = comment_data['comment_view']['comment']['id']
-                        comment_made = True
-                    except:
-                        logging.error(f"Could not push child comment {item['data']['id']}")
-                        with open(f"output/errors/{item['data']['id']}.json", 'w') as f:
-                            f.write(json.dumps(item, indent=4))
-                else:
-                    try:
-                        comment_data = lemmy.comment.create(int(post_data['post_view']['post']['id']), item['data']['body'])
-                        comment['lemmy_comment_id'] = comment_data['comment_view']['comment']['id']
-                        comment_made = True
-                    except:
-                        logging.error(f"Could not push comment {item['data']['id']}")
-                        with open(f"output/errors/{item['data']['id']}.json", 'w') as f:
-                            f.write(json.dumps(item, indent=4))
-
-                if (comment_made):
-                    # Copy over the score of the comment
-                    try:
-                        fix_comment_score(pg, comment_data, item)
-                    except:
-                        logging.error(f"Could not fix comment score {item['data']['id']}")
-                        try:
-                            with open(f"output/errors/{item['data']['id']}_score.json", 'w') as f:
-                                f.write(json.dumps(comment_data, indent=4))
-                            with open(f"output/errors/{item['data']['id']}.json", 'w') as f:
-                                f.write(json.dumps(item, indent=4))
-                        except:
-                            logging.critical(f"Comment has no comment_data {item['data']['id']}")
-                    
-                    # Save the comment information to sqlite3
-                    try:
-                        save_entry(db, comment_data=comment_data, comment=comment)
-                    except:
-                        logging.error(f"Could not save comment information to sqlite3")
-                        try:
-                            with open(f"output/errors/{comment['lemmy_comment_id']}.json", 'w') as f:
-                                f.write(json.dumps(comment, indent=4))
-                        except:
-                            logging.critical(f"Could not save comment error data")
-
-            # Loop through any replies to the comment to follow comment chains
-            if (item['data']['replies'] != ""):
+                # Queue the score of the comment to be copied over
                 try:
-                    parse_comments(pg, lemmy, post_data, item['data']['replies'], post, db, comment_data)
+                    fix_comment_score(score_updates, comment_data, item)
                 except:
-                    logging.error(f"Could not handle comment reply {item['data']['id']}")
-                    try:
-                        with open(f"output/errors/{item['data']['id']}_score.json", 'w') as f:
-                            f.write(json.dumps(comment_data, indent=4))
-                        with open(f"output/errors/{item['data']['id']}.json", 'w') as f:
-                            f.write(json.dumps(item, indent=4))
-                    except:
-                        logging.critical(f"Comment has no comment_data {item['data']['id']}")
+                    logging.error(f"Could not fix comment score {item.id}")
+                    error_queue.put(('comment_score', comment_data))
+                    error_queue.put(('comment', item))
+                    complete = False
+
+                # Queue the comment information to be saved to sqlite3
+                entries.append((item.id, lemmy_comment_id, post.id, lemmy_post_id, item.score))
+
+            # Queue any replies to the comment to follow comment chains
+            # Replies to a comment that could not be pushed are posted at the top level
+            next_level.extend((lemmy_comment_id, child) for child in flatten_comments(item.replies))
 
-    return True
+        # Save the level's comment information to sqlite3 at once
+        try:
+            save_entries(db, comments=entries)
+        except:
+            logging.error(f"Could not save comment information to sqlite3")
+            error_queue.put(('comment_entries', {'reddit_post_id': post.id, 'entries': entries}))
+            complete = False
+
+        # Copy over the scores of the level's comments at once
+        try:
+            flush_comment_scores(pg_cursor, score_updates)
+        except:
+            pg_cursor.connection.rollback()
+            logging.error(f"Could not fix comment scores for post {post.id}")
+            error_queue.put(('comment_scores', {'reddit_post_id': post.id, 'scores': score_updates}))
+            complete = False
+
+        level = next_level
+
+    return complete
 
 def load_example_data():
     """Load example data for testing purposes
     """
 
-    with open('output/example.json', 'r') as f:
-        data = json.load(f)
+    with open('output/example.json', 'rb') as f:
+        data = orjson.loads(f.read())
     return data
 
-def copy_post(lemmy: Lemmy, pg: psycopg2.extensions.connection, permalink: str, db: sqlite3.Connection, comments: bool = True):
+@retry(wait=wait_exponential(multiplier=1, max=30), stop=stop_after_attempt(5), retry=retry_if_exception_type((requests.RequestException, TimeoutError)), reraise=True)
+async def create_post(lemmy: Lemmy, community_id: int, post: RedditPost):
+    """Create the post on Lemmy, retrying with exponential backoff to handle rate limits or other reasons for failure
+    Will attempt 5 times before giving up
+    lemmy -> Lemmy instance connection
+    community_id -> ID of the Lemmy community to post in
+    post -> post parsed from Reddit API
+    """
+
+    post_data = await run_lemmy(lemmy.post.create, community_id, post.title, post.url, f"{post.body} \n\n Originally Posted on r/{post.subreddit} by u/{post.creator_id}", post.nsfw)
+    if (not post_data):
+        # pythorhead swallows request errors and returns None
+        logging.warning(f"Could not create post {post.id}, retrying")
+        raise requests.RequestException(f"Lemmy did not return post {post.id}")
+    return post_data
+
+async def copy_post(session: aiohttp.ClientSession, lemmy: Lemmy, pg_cursor: psycopg2.extensions.cursor, community_id: int, permalink: str, db: sqlite3.Connection, post_scores: list, copied_posts: list, comments: bool = True):
     """Copy post from Reddit to Lemmy
+    session -> shared aiohttp client session
     lemmy -> Lemmy instance connection
-    pg -> postgres db connection
+    pg_cursor -> long-lived postgres cursor
+    community_id -> ID of the Lemmy community matching the subreddit
     permalink -> Reddit post permalink (i.e. /r/tifu/comments/xxx/xxx)
+    post_scores -> list collecting (post_id, score) tuples, flushed once per subreddit
+    copied_posts -> list collecting (post_score, post_hash, reddit_post_id) tuples of finished posts, saved by update_posts after the flush
     comments -> whether to copy comments, defaults True
     """
     
     # Receive Reddit API response and process it
-    data = get_json(permalink) 
-    post = {
-        'title': data[0]['data']['children'][0]['data']['title'],
-        'url': data[0]['data']['children'][0]['data']['url'],
-        'body': data[0]['data']['children'][0]['data']['selftext'],
-        'creator_id': data[0]['data']['children'][0]['data']['author'],
-        'subreddit': data[0]['data']['children'][0]['data']['subreddit'],
-        'nsfw': data[0]['data']['children'][0]['data']['over_18'],
-        'score': data[0]['data']['children'][0]['data']['score'],
-        'id': data[0]['data']['children'][0]['data']['id']
-    }
-
-    # Find the ID of matching community name on Lemmy
-    post['community_id'] = lemmy.community.get(name=post['subreddit'])['community_view']['community']['id']
-
-    # While loop is here to handle rate limits or other reasons for post copy failure
-    # Will attempt 5 times before skipping
-    attempts = 0
+    # Without comments only the post is needed, so skip downloading the comment thread
+    data = await get_json(session, permalink, 10000 if comments else 1)
+    post_json = data[0]['data']['children'][0]['data']
+    post = RedditPost(**{key: post_json[field] for key, field in POST_FIELDS.items()})
+
     post_made = False
-    post_data = check_dupe(db, post=post)
+    post_data = check_dupe(db, post)
     if (post_data):
-        logging.info(f"Duplicate post found: {post['title']}")
+        # A post that was not finished on an earlier run, pick up its comments where they stopped
+        logging.info(f"Duplicate post found: {post.title}")
         post_data = {
             'post_view': {
                 'post': {
-                    "id": post_data['lemmy_post_id']
+                    "id": int(post_data['lemmy_post_id'])
                 }
             }
         }
+        fix_post_score(post_scores, post_data, post)
     else:
-        while True:
-            try:
-                post_data = lemmy.post.create(post['community_id'], post['title'], post['url'], f"{post['body']} \n\n Originally Posted on r/{post['subreddit']} by u/{post['creator_id']}", post['nsfw'])
-                fix_post_score(pg, post_data, post)
-                post_made = True
-                break
-            except:
-                if (attempts == 5):
-                    logging.critical(f'Post could not be copied, skipping')
-                    logging.critical(post)
-                    post_made = False
-                    break
-                logging.warning(f'Something went wrong, retrying {attempts}')
-                time.sleep(30)
-                attempts += 1 
-    
+        try:
+            post_data = await create_post(lemmy, community_id, post)
+            fix_post_score(post_scores, post_data, post)
+            post_made = True
+        except:
+            logging.critical(f'Post could not be copied, skipping')
+            logging.critical(post)
+            return
+
     if (post_made):
-        logging.info(f"Post Created: {post['title']}")
-        save_entry(db, post_data=post_data, post=post)
+        logging.info(f"Post Created: {post.title}")
+        # Saved right away so a crash while copying comments resumes this post instead of copying it twice
+        # The post only counts as finished once it has a post_hash, see copied_posts
+        try:
+            save_entries(db, posts=[(post.id, post_data['post_view']['post']['id'], post.score)])
+        except:
+            logging.error(f"Could not save post information to sqlite3")
+            error_queue.put(('post_entry', post))
 
     # Copy over comments if requested
     if (comments):
-        comment_data = parse_comments(pg, lemmy, post_data, data[1], post, db)
+        # The comments that did load are still copied even if some could not be
+        loaded = await load_more_comments(session, post.id, data[1])
+        copied = await parse_comments(lemmy, pg_cursor, post_data, data[1], post, db)
+        if (not loaded or not copied):
+            # Left without a post_hash so the comments that failed are retried next run
+            logging.error(f"Not all comments of post {post.id} were copied, it will be resumed next run")
+            return
+
+    # The post is finished once all of its comments have been copied
+    copied_posts.append((post.score, post_hash(post.title, post.body, post.url, post.score), post.id))
+
+async def get_permalinks(session: aiohttp.ClientSession, db: sqlite3.Connection, sub: str):
+    """Get the permalinks of the posts on a subreddit frontpage, skipping sticky posts and posts already copied
+    Posts already copied are skipped before their comment tree is ever fetched
+    Posts without a post_hash were not finished, so they are copied again and resume where they stopped
+    Returns (permalinks, changed), changed lists copied posts whose content hash differs as (post_score, post_hash, reddit_post_id, lemmy_post_id) tuples
+    session -> shared aiohttp client session
+    db -> sqlite3 db connection
+    sub -> subreddit name (i.e. tifu)
+    """
+
+    try:
+        posts = await get_frontpage(session, f'/r/{sub}/')
+    except Exception as e:
+        # Rate limits or server errors that outlasted the retries, or a body that isn't JSON
+        # Log the error and move on to the next subreddit
+        logging.error(f"Could not get the frontpage of {sub}: {e}")
+        error_queue.put(('frontpage', {'subreddit': sub, 'error': repr(e)}))
+        return [], []
+
+    try:
+        # Each simdjson lookup builds a new proxy object, so each post's data is looked up once
+        # The fields post_hash needs are read for every post, the rest of the listing (media, previews, awards) is never converted
+        frontpage = [
+            (data['id'], data['permalink'], data['score'], post_hash(data['title'], data['selftext'], data['url'], data['score']))
+            for data in (post['data'] for post in posts['data']['children']) if not data['stickied']
+        ]
+    except:
+        # The response can be any JSON value, only objects carry a 'reason'
+        if (isinstance(posts, simdjson.Object) and posts.get('reason') == 'banned'):
+            # Some subs would fail because they have been banned
+            # Log the error and keep moving
+            logging.error(f"{sub} has been banned")
+        elif (isinstance(posts, simdjson.Object)):
+            error_queue.put(('frontpage', {'subreddit': sub, 'response': posts.as_dict()}))
+        elif (isinstance(posts, simdjson.Array)):
+            error_queue.put(('frontpage', {'subreddit': sub, 'response': posts.as_list()}))
+        else:
+            error_queue.put(('frontpage', {'subreddit': sub, 'response': posts}))
+        return [], []
+
+    seen = load_seen_posts(db, [reddit_post_id for reddit_post_id, permalink, score, content_hash in frontpage])
+    permalinks = []
+    changed = []
+    for reddit_post_id, permalink, score, content_hash in frontpage:
+        if (reddit_post_id not in seen or seen[reddit_post_id][1] is None):
+            permalinks.append(permalink)
+        elif (seen[reddit_post_id][1] != content_hash):
+            # Only posts that changed since they were copied get their score fixed again
+            changed.append((score, content_hash, reddit_post_id, int(seen[reddit_post_id][0])))
+    return permalinks, changed
+
+async def copy_subreddit(session: aiohttp.ClientSession, lemmy: Lemmy, pg_cursor: psycopg2.extensions.cursor, db: sqlite3.Connection, sub: str, permalinks: list, changed: list, bar, comments: bool = True):
+    """Copy the frontpage posts of a subreddit to Lemmy
+    Up to POST_CONCURRENCY posts are copied at once, Reddit requests are paced by reddit_limiter
+    session -> shared aiohttp client session
+    lemmy -> Lemmy instance connection
+    pg_cursor -> long-lived postgres cursor
+    db -> sqlite3 db connection
+    sub -> subreddit name (i.e. tifu)
+    permalinks -> Reddit post permalinks to copy
+    changed -> copied posts that changed on Reddit, as returned by get_permalinks
+    bar -> alive_bar progress bar, advanced once per post
+    comments -> whether to copy comments, defaults True
+    """
+
+    async def copy_post_slot(permalink: str):
+        async with post_slots:
+            await copy_post(session, lemmy, pg_cursor, community_id, permalink, db, post_scores, copied_posts, comments)
+
+    # Posts that changed since they were copied only need their score fixed
+    post_scores = [(lemmy_post_id, score) for score, content_hash, reddit_post_id, lemmy_post_id in changed]
+    copied_posts = [(score, content_hash, reddit_post_id) for score, content_hash, reddit_post_id, lemmy_post_id in changed]
+
+    if (permalinks):
+        # Find the ID of matching community name on Lemmy once for the whole subreddit
+        # Done off the event loop so the lookup does not stall the other subreddits
+        try:
+            community_id = await run_lemmy(get_community_id, lemmy, sub)
+        except:
+            logging.error(f"Could not find a Lemmy community for {sub}, skipping")
+            bar(len(permalinks), skipped=True)
+            permalinks = []
+
+        tasks = [copy_post_slot(permalink) for permalink in permalinks]
+        for task in asyncio.as_completed(tasks):
+            try:
+                await task
+            except Exception as e:
+                logging.error(f"Could not copy post from {sub}: {e}")
+            bar()
+
+    # Copy over the scores of all posts at once
+    try:
+        flush_post_scores(pg_cursor, post_scores)
+    except:
+        pg_cursor.connection.rollback()
+        logging.error(f"Could not fix post scores for {sub}")
+        error_queue.put(('post_scores', {'subreddit': sub, 'scores': post_scores}))
+        return
 
-def main():
+    # Hashes are only saved once the new scores are on Lemmy, otherwise they would be skipped next run
+    # This covers new posts too, they are saved without a hash so a failed flush or crash is resumed next run
+    if (copied_posts):
+        try:
+            update_posts(db, copied_posts)
+        except:
+            logging.error(f"Could not save post hashes to sqlite3 for {sub}")
+
+async def main():
     """Main function
     Gets the data from Reddit 
     Sorts through what should and should not go to Lemmy
     """
 
     # Load data and initialize connections
-    config = load_yaml('config.yml')
+    config = load_config('config.yml')
+    error_thread = threading.Thread(target=write_error_log, args=('output/errors/errors.ndjson',), daemon=True)
+    error_thread.start()
     lemmy = lemmy_setup(config)
     pg = pg_setup(config)
+    pg_cursor = pg.cursor()
     db = load_db("rlc.db")
-    
-    # Loop through subreddits where we want comments
-    for sub in config['subreddits']:
-        posts = get_frontpage(f'/r/{sub}/')
-        try:
-            with alive_bar(len(posts['data']['children'])) as bar:
-                for post in posts['data']['children']:
-                    if (post['data']['stickied'] == True):
-                        # Skip sticky posts
-                        pass
-                    else:
-                        start = time.time()
-                        copy_post(lemmy, pg, post['data']['permalink'], db)
-                        end = time.time()
-
-                        # Want to make sure we stay under the Reddit rate limit
-                        # 10 per minute
-                        # Lemmy request times make this unnecessary, but is a precaution
-                        if ((end - start) < 10):
-                            time.sleep(10 - (end - start))
-                    bar()
-        except:
-            try:
-                if (posts['reason'] == 'banned'):
-                    # Some subs would fail because they have been banned
-                    # Log the error and keep moving
-                    logging.error(f"{sub} has been banned")
-            except:
-                with open(f'output/errors/{sub}.json', 'w') as f:
-                    f.write(json.dumps(posts, indent=4))
-        
-        time.sleep(120)
-    
-    # Loop through subreddits where we only want pictures/links
-    for sub in config['po_subreddits']:
-        posts = get_frontpage(f'/r/{sub}/')
-        try:
-            with alive_bar(len(posts['data']['children'])) as bar:
-                for post in posts['data']['children']:
-                    if (post['data']['stickied'] == True):
-                        # Skip sticky posts
-                        pass
-                    else:
-                        start = time.time()
-                        copy_post(lemmy, pg, post['data']['permalink'], db, False)
-                        end = time.time()
-
-                        # Want to make sure we stay under the Reddit rate limit
-                        # 10 per minute
-                        # Lemmy request times make this unnecessary, but is a precaution
-                        if ((end - start) < 10):
-                            time.sleep(10 - (end - start))
-                    bar()
-        except:
-            try:
-                if (posts['reason'] == 'banned'):
-                    # Some subs would fail because they have been banned
-                    # Log the error and keep moving
-                    logging.error(f"{sub} has been banned")
-            except:
-                with open(f'output/errors/{sub}.json', 'w') as f:
-                    f.write(json.dumps(posts, indent=4))
 
-        time.sleep(120)
+    # Subreddits where we want comments, then subreddits where we only want pictures/links
+    subs = [(sub, True) for sub in config.subreddits] + [(sub, False) for sub in config.po_subreddits]
+
+    async with aiohttp.ClientSession(headers={'User-agent': 'RLC 0.1'}, connector=aiohttp.TCPConnector(limit=8)) as session:
+        # Posts copied on a previous run are skipped entirely, unless they changed and need a score fix
+        frontpages = await asyncio.gather(*(get_permalinks(session, db, sub) for sub, comments in subs))
+
+        # All subreddits share reddit_limiter, so Lemmy work for one post overlaps the wait for the next
+        # bar() only bumps a counter, redrawing is done by alive_bar's own thread, capped here at twice a second
+        with alive_bar(sum(len(permalinks) for permalinks, changed in frontpages), refresh_secs=0.5) as bar:
+            await asyncio.gather(*(copy_subreddit(session, lemmy, pg_cursor, db, sub, permalinks, changed, bar, comments) for (sub, comments), (permalinks, changed) in zip(subs, frontpages)))
 
     db.commit()
     db.close()
+    pg_cursor.close()
     pg.close()
+    lemmy_pool.shutdown()
+
+    # Let the error log finish writing
+    error_queue.put(None)
+    error_thread.join()
         
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    asyncio.run(main())